@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+
+from url import UNCACHED_HEADERS, CachedResponse
+
+def archive_key(url, payload):
+  if payload:
+    return "POST " + str(url) + " " + payload
+  return "GET " + str(url)
+
+# Appends every response the browser receives (status, headers and decoded
+# body) to an archive file, one JSON object per line
+class Recorder:
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+
+  # Cached and replayed responses already hold their whole body
+  def watch(self, url, payload, response):
+    key = archive_key(url, payload)
+    if isinstance(response, CachedResponse):
+      self.record(key, response.status, response.headers, response.body)
+    else:
+      response.on_body.append(lambda body: \
+        self.record(key, response.status, response.headers, body))
+
+  def record(self, key, status, headers, body):
+    entry = {
+      "key": key,
+      "status": status,
+      "headers": {k: v for k, v in headers.items()
+                  if k not in UNCACHED_HEADERS},
+      "body": base64.b64encode(body).decode("ascii"),
+    }
+    with self.lock:
+      with open(self.path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+# Serves responses from an archive instead of the network. latency (in
+# seconds) is added before every response and bandwidth (bytes per second,
+# 0 for unlimited) paces the body.
+class Replay:
+  def __init__(self, path, latency=0, bandwidth=0):
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.entries = {}
+    with open(path) as f:
+      for line in f:
+        entry = json.loads(line)
+        self.entries[entry["key"]] = entry
+
+  def lookup(self, url, payload):
+    entry = self.entries.get(archive_key(url, payload))
+    if entry:
+      status = entry["status"]
+      headers = entry["headers"]
+      body = base64.b64decode(entry["body"])
+    else:
+      status, headers = "404", {}
+      body = "<h1>{} is not in the archive</h1>".format(url).encode("utf8")
+    print("Request URL:", str(url))
+    print("Status:", status, "(replayed)")
+    return status, headers, body
+
+  def open(self, url, payload=None):
+    status, headers, body = self.lookup(url, payload)
+    time.sleep(self.latency)
+    return ReplayResponse(status, headers, body, self.bandwidth)
+
+  async def open_async(self, url, payload=None):
+    status, headers, body = self.lookup(url, payload)
+    await asyncio.sleep(self.latency)
+    return AsyncReplayResponse(status, headers, body, self.bandwidth)
+
+
+class ReplayResponse(CachedResponse):
+  def __init__(self, status, headers, body, bandwidth):
+    super().__init__(status, headers, body)
+    self.bandwidth = bandwidth
+    self.from_cache = False
+    self.bytes_received = len(body)
+
+  def chunks(self):
+    for chunk in CachedResponse.chunks(self):
+      if self.bandwidth:
+        time.sleep(len(chunk) / self.bandwidth)
+      yield chunk
+
+  def read(self):
+    return b"".join(self.chunks())
+
+
+class AsyncReplayResponse(ReplayResponse):
+  async def chunks(self):
+    for chunk in CachedResponse.chunks(self):
+      if self.bandwidth:
+        await asyncio.sleep(len(chunk) / self.bandwidth)
+      yield chunk
+
+  async def read(self):
+    return b"".join([chunk async for chunk in self.chunks()])
@@ -0,0 +1,72 @@
+import argparse
+import re
+import sys
+import time
+import tracemalloc
+from parser import HTMLParser, Text
+
+from dom import CompactElement, CompactHTMLParser
+from globals import tree_to_list
+
+TOKENS = re.compile("<[^>]*>|[^<]+") # a tag, or the text between two tags
+PARAGRAPH = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed " \
+  "do eiusmod tempor incididunt ut labore et dolore magna aliqua. "
+
+# A page of blog-style posts about size bytes long
+def make_document(size):
+  parts = ["<!doctype html><html><head><title>Benchmark</title>",
+           "<link rel=\"stylesheet\" href=\"/style.css\"></head><body>"]
+  length = sum(len(part) for part in parts)
+  i = 0
+  while length < size:
+    post = "<div class=\"post\"><h2>Post " + str(i) + "</h2><p>" + \
+      PARAGRAPH * 3 + "<a href=\"/posts/" + str(i) + "\">Read more</a> " + \
+      "<b>" + PARAGRAPH + "</b>" + PARAGRAPH * 2 + "</p></div>\n"
+    parts.append(post)
+    length += len(post)
+    i += 1
+  parts.append("</body></html>")
+  return "".join(parts)
+
+def bench_parse(megabytes, parser_class):
+  body = make_document(megabytes * 1024 * 1024)
+  tokens = len(TOKENS.findall(body))
+  start = time.perf_counter()
+  parser_class(body).parse()
+  elapsed = time.perf_counter() - start
+  print("parse %3d MB: %8d tokens in %6.2fs  %10.0f tokens/s  %6.2f MB/s" % (
+    megabytes, tokens, elapsed, tokens / elapsed, len(body) / elapsed / 1024 / 1024))
+
+# Memory held by the parsed tree, not counting the document text
+def bench_memory(megabytes, parser_class):
+  body = make_document(megabytes * 1024 * 1024)
+  tracemalloc.start()
+  tree = parser_class(body).parse()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  nodes = tree_to_list(tree, [])
+  # the text itself takes about the same room however nodes are stored
+  if isinstance(tree, CompactElement):
+    text = sys.getsizeof(tree.dom.text)
+  else:
+    text = sum(sys.getsizeof(node.text) for node in nodes
+               if isinstance(node, Text))
+  print("memory %3d MB: %8d nodes in %6.1f MB  %6.1f bytes/node, "
+        "%6.1f without text" % (megabytes, len(nodes), size / 1024 / 1024,
+                                size / len(nodes), (size - text) / len(nodes)))
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("sizes", nargs="*", type=int, default=[1, 10],
+                      help="document sizes to parse, in megabytes")
+  parser.add_argument("--memory", action="store_true",
+                      help="measure bytes per DOM node instead of speed")
+  parser.add_argument("--compact", action="store_true",
+                      help="build the struct-of-arrays DOM from dom.py")
+  args = parser.parse_args()
+  parser_class = CompactHTMLParser if args.compact else HTMLParser
+  for megabytes in args.sizes:
+    if args.memory:
+      bench_memory(megabytes, parser_class)
+    else:
+      bench_parse(megabytes, parser_class)
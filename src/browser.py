@@ -1,14 +1,31 @@
+import asyncio
+import json
 import tkinter
 import urllib.parse
+from collections import deque
 from parser import Element, HTMLParser, Text
 
+from cache import MemoryCache, fetch_stylesheets, open_text
 from css import CSSParser, cascade_priority, style
 from globals import HEIGHT, SCROLL_STEP, VSTEP, WIDTH, Rect, tree_to_list
 from layout import (DocumentLayout, DrawLine, DrawOutline, DrawRect, DrawText,
                     get_font)
-from url import URL
+from prefetch import Prefetcher
+from scheduler import NAVIGATION, SCHEDULER
+from url import RESOURCE_LOG, URL
 
 DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
+ASYNC_POLL_MS = 10 # how often Tk hands control to the asyncio loop
+ASYNC_SLICE_MS = 5 # how long the asyncio loop runs each time
+PROGRESSIVE_PAINT_BYTES = 8 * 1024 # body received before the first paint
+RESOURCE_LOG_SIZE = 1000 # requests remembered per tab
+BFCACHE_SIZE = 64 * 1024 * 1024 # bytes, estimated, for all tabs
+BFCACHE_TTL = 10 * 60 # seconds a page is kept for going back to
+BFCACHE_OBJECT_SIZE = 400 # rough bytes per node, layout object or command
+
+# Pages the user navigated away from, ready to be shown again on going back
+# without fetching, parsing or laying them out
+BFCACHE = MemoryCache(BFCACHE_SIZE)
 
  # A simple Chrome wrapper for the browser
 class Chrome:
@@ -177,11 +194,26 @@ class Browser:
     self.window.bind("<Key>", self.handle_key)
     self.window.bind("<Return>", self.handle_enter)
     self.window.bind("<BackSpace>", self.handle_backspace)
+    self.window.bind("<F12>", self.handle_dump_resources)
+    self.window.bind("<Motion>", self.handle_motion)
 
     self.tabs = []
     self.active_tab = None
     self.chrome = Chrome(self)
 
+    # Network requests run on an asyncio loop that Tk's event loop pumps,
+    # so the window keeps handling events while pages load
+    self.loop = asyncio.new_event_loop()
+    self.pump_loop()
+
+  # Runs the asyncio loop for a slice of time rather than one iteration,
+  # since a single chunk of a download can take several iterations. An
+  # idle loop spends the slice waiting on its sockets.
+  def pump_loop(self):
+    self.loop.call_later(ASYNC_SLICE_MS / 1000, self.loop.stop)
+    self.loop.run_forever()
+    self.window.after(ASYNC_POLL_MS, self.pump_loop)
+
   def handle_down(self, e):
     self.active_tab.scrolldown()
     self.draw()
@@ -218,6 +250,14 @@ class Browser:
     self.chrome.backspace()
     self.draw()
 
+  def handle_dump_resources(self, e):
+    print(self.active_tab.resource_log_json())
+    print("Prefetch:", json.dumps(self.active_tab.prefetcher.stats()))
+
+  def handle_motion(self, e):
+    if self.active_tab and e.y >= self.chrome.bottom:
+      self.active_tab.hover(e.x, e.y - self.chrome.bottom)
+
   def draw(self):
     self.canvas.delete("all")
     self.active_tab.draw(self.canvas, self.chrome.bottom)
@@ -225,7 +265,7 @@ class Browser:
       cmd.execute(0, self.canvas)
 
   def new_tab(self, url):
-    new_tab = Tab(HEIGHT - self.chrome.bottom)
+    new_tab = Tab(self, HEIGHT - self.chrome.bottom)
     new_tab.load(url)
     self.active_tab = new_tab
     self.tabs.append(new_tab)
@@ -233,37 +273,124 @@ class Browser:
 
 
 class Tab:
-  def __init__(self, tab_height):
+  # set by main.py to dom.CompactHTMLParser for very large pages
+  parser_class = HTMLParser
+
+  def __init__(self, browser, tab_height):
+    self.browser = browser
     self.scroll = 0
     self.max_scroll = 0
     self.url = None
     self.tab_height = tab_height
     self.history = []
     self.focus = None
-    
+    self.document = None
+    self.display_list = []
+    self.links = [] # (rect, url) of every laid out link
+    self.loading = None
+    self.loaded = False
+    # timing records for every request this tab makes, see URL.open
+    self.resources = deque(maxlen=RESOURCE_LOG_SIZE)
+    self.prefetcher = Prefetcher()
+    self.prefetch_pending = False
+    self.hovered = None
+
   def load(self, url, payload=None):
+    self.save_page()
+    return self.navigate(url, payload)
+
+  # Starts loading url on the browser's asyncio loop. Whatever the previous
+  # page was still fetching, queued or not, is abandoned.
+  def navigate(self, url, payload=None):
+    SCHEDULER.cancel(self)
+    self.loaded = False
+    self.prefetcher.opened(url)
+    self.prefetcher.reset()
+    self.hovered = None
     self.url = url
     self.history.append(url)
-    body = url.request(payload)
-
-    self.nodes = HTMLParser(body).parse()
+    self.loading = SCHEDULER.track(
+      self, self.browser.loop.create_task(self.load_async(url, payload)))
+    self.loading.add_done_callback(self.load_done)
+    return self.loading
+
+  # Replaces the page with an error page when loading it failed, unless the
+  # tab has moved on since
+  def load_done(self, task):
+    if task.cancelled() or task is not self.loading or not task.exception():
+      return
+    error = task.exception()
+    print("Navigation failed:", str(self.url), repr(error))
+    self.loading = SCHEDULER.track(self, self.browser.loop.create_task(
+      self.show(self.url, error_page(self.url, error))))
+
+  # Parses the body as it arrives and paints the document so far at 8KB,
+  # 16KB, 32KB... of it, so the first screen shows up long before a large
+  # page finishes. Laying out at doubling sizes keeps the total work linear.
+  async def load_async(self, url, payload=None):
+    # requests made by this task and the tasks it starts are logged here
+    RESOURCE_LOG.set(self.resources)
+    self.stylesheets = {}
+    parser = self.parser_class()
+    received = 0
+    next_paint = PROGRESSIVE_PAINT_BYTES
+    # the slot covers the request, not the body download, which would
+    # otherwise hold it while waiting on this page's own stylesheets
+    async with SCHEDULER.slot(url.host, NAVIGATION):
+      url, chunks = await open_text(url, payload)
+    # after redirects, links resolve against (and history records) the
+    # final location
+    self.url = url
+    self.history[-1] = url
+    async for text in chunks:
+      parser.feed(text)
+      received += len(text)
+      if received >= next_paint and parser.tree():
+        await self.show(url, parser.tree())
+        next_paint = 2 * received
+    # closing may still add text that followed the last tag
+    await self.show(url, parser.close())
+    self.loaded = True
+
+  async def show(self, url, tree):
+    self.nodes = tree
     self.rules = DEFAULT_STYLE_SHEET.copy()
 
-    links = [node.attributes["href"]
-             for node in tree_to_list(self.nodes, [])
+    nodes = tree_to_list(self.nodes, [])
+    links = [url.resolve(node.attributes["href"])
+             for node in nodes
              if isinstance(node, Element)
              and node.tag == "link"
              and node.attributes.get("rel") == "stylesheet"
              and "href" in node.attributes]
-    for link in links:
-      style_url = url.resolve(link)
-      try:
-        body = style_url.request()
-      except:
-        continue
-      self.rules.extend(CSSParser(body).parse())
+    links = [link for link in links if url.can_load(link)]
+    # Start DNS lookups for linked hosts so clicking a link won't wait on them
+    for node in nodes:
+      if isinstance(node, Element) and node.tag == "a" \
+          and "href" in node.attributes:
+        try:
+          link = url.resolve(node.attributes["href"])
+        except ValueError:
+          continue # a malformed href only fails when it's clicked
+        if link.scheme in ("http", "https"):
+          URL.resolver.prefetch(link.host)
+    # Fetch every sheet at once, pipelining those from the same host, but
+    # add the rules in document order so the cascade doesn't depend on
+    # which download finishes first. Sheets found in an earlier partial
+    # parse are already on their way.
+    new_links = list(dict.fromkeys(link for link in links
+                                   if link not in self.stylesheets))
+    self.stylesheets.update(zip(new_links, fetch_stylesheets(new_links, self)))
+    sheets = await asyncio.gather(*[self.stylesheets[link] for link in links])
+    for rules in sheets:
+      self.rules.extend(rules)
 
     self.render()
+    self.browser.draw()
+    self.schedule_prefetch()
+
+  def resource_log_json(self):
+    return json.dumps(list(self.resources), indent=2)
 
   def render(self):
     style(self.nodes, sorted(self.rules, key=cascade_priority))
@@ -271,6 +398,14 @@ class Tab:
     self.document.layout()
     self.display_list = []
     paint_tree(self.document, self.display_list)
+    # where each link is laid out, so that hovering and prefetching don't
+    # walk the whole layout tree on every mouse move
+    self.links = []
+    for obj in tree_to_list(self.document, []):
+      link = self.link_of(obj.node) if obj.y is not None else None
+      if link:
+        self.links.append(
+          (Rect(obj.x, obj.y, obj.x + obj.width, obj.y + obj.height), link))
   
 
   def draw(self, canvas, offset):
@@ -282,19 +417,73 @@ class Tab:
       cmd.execute(self.scroll - offset, canvas)
   
   def scrolldown(self):
+    if not self.document:
+      return
     max_y = max(self.document.height + 2*VSTEP - self.tab_height, 0)
     self.scroll = min(self.scroll + SCROLL_STEP, max_y)
+    self.schedule_prefetch()
 
   def scrollup(self, e):
     self.scroll -= SCROLL_STEP
     if self.scroll < 0:
       self.scroll = 0
+    self.schedule_prefetch()
+
+  # Once Tk has nothing else to do, starts prefetching the hovered link and
+  # the same-origin links on screen
+  def schedule_prefetch(self):
+    if not self.prefetch_pending:
+      self.prefetch_pending = True
+      self.browser.window.after_idle(self.prefetch_links)
+
+  def prefetch_links(self):
+    self.prefetch_pending = False
+    if not self.document or self.url.scheme not in ("http", "https"):
+      return
+    top, bottom = self.scroll, self.scroll + self.tab_height
+    links = [self.hovered] if self.hovered else []
+    links.extend(link for rect, link in self.links
+                 if rect.top < bottom and rect.bottom > top)
+    for link in links:
+      if (link.scheme, link.host, link.port) == \
+          (self.url.scheme, self.url.host, self.url.port) \
+          and link != self.url and self.prefetcher.wants(link):
+        SCHEDULER.track(self, self.browser.loop.create_task(
+          self.prefetcher.fetch(link)))
+
+  def hover(self, x, y):
+    if not self.document:
+      return
+    y += self.scroll
+    link = None
+    for rect, area_link in self.links:
+      if rect.containsPoint(x, y):
+        link = area_link
+    if link and link != self.hovered:
+      self.hovered = link
+      self.schedule_prefetch()
+
+  # The URL of the <a href> that node is inside of, if any. A malformed
+  # href has none, so it is neither hovered nor prefetched.
+  def link_of(self, node):
+    while node:
+      if isinstance(node, Element) and node.tag == "a" \
+          and "href" in node.attributes \
+          and not node.attributes["href"].startswith("#"):
+        try:
+          return self.url.resolve(node.attributes["href"])
+        except ValueError:
+          return None
+      node = node.parent
+    return None
   
   def click(self, x, y):
     # 이전 focus 해제
     if self.focus:
       self.focus.is_focused = False
     self.focus = None
+    if not self.document:
+      return
     y += self.scroll
     objs = [obj for obj in tree_to_list(self.document, [])
             if obj.x <= x < obj.x + obj.width
@@ -307,8 +496,7 @@ class Tab:
         pass
       elif elt.tag == "a" and "href" in elt.attributes:
         url = self.url.resolve(elt.attributes["href"])
-        self.load(url)
-        return
+        return self.follow(url)
       elif elt.tag == "input":
         elt.attributes["value"] = ""
         if self.focus:
@@ -336,13 +524,53 @@ class Tab:
     body = body[1:]
 
     url = self.url.resolve(elt.attributes["action"])
-    self.load(url, body)
+    self.follow(url, body)
+
+  # Loads a URL the page links to, unless it's a local one the page isn't
+  # allowed to reach
+  def follow(self, url, payload=None):
+    if not self.url.can_load(url):
+      print("Blocked:", str(url), "from", str(self.url))
+      return
+    self.load(url, payload)
   
   def go_back(self):
     if len(self.history) > 1:
       self.history.pop()
       back = self.history.pop()
-      self.load(back)
+      if not self.restore_page(back):
+        self.navigate(back)
+
+  # Keeps the current page in the back/forward cache under its place in the
+  # history. Pages that hadn't finished loading are just dropped.
+  def save_page(self):
+    if not self.loaded:
+      return
+    key = (self, len(self.history) - 1, self.url)
+    page = (self.nodes, self.rules, self.document, self.display_list,
+            self.links, self.scroll)
+    objects = len(tree_to_list(self.nodes, [])) + \
+      len(tree_to_list(self.document, [])) + len(self.display_list)
+    BFCACHE.put(key, page, objects * BFCACHE_OBJECT_SIZE, BFCACHE_TTL)
+
+  def restore_page(self, url):
+    key = (self, len(self.history), url)
+    page = BFCACHE.get(key)
+    if not page:
+      return False
+    BFCACHE.invalidate(key)
+    SCHEDULER.cancel(self)
+    self.prefetcher.opened(url)
+    self.prefetcher.reset()
+    self.hovered = None
+    self.focus = None
+    self.url = url
+    self.history.append(url)
+    self.nodes, self.rules, self.document, self.display_list, self.links, \
+      self.scroll = page
+    self.loaded = True
+    self.schedule_prefetch()
+    return True
 
   def keypress(self, char):
     if self.focus:
@@ -350,6 +578,18 @@ class Tab:
       self.render()
 
 
+# A document saying why url couldn't be loaded, built directly so that the
+# error text isn't parsed as HTML
+def error_page(url, error):
+  root = Element("html", {}, None)
+  body = Element("body", {}, root)
+  root.children.append(body)
+  for line in ("Couldn't load " + str(url), repr(error)):
+    paragraph = Element("p", {}, body)
+    paragraph.children.append(Text(line, paragraph))
+    body.children.append(paragraph)
+  return root
+
 def paint_tree(layout_object, display_list):
   if layout_object.should_paint():
     display_list.extend(layout_object.paint())
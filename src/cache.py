@@ -0,0 +1,225 @@
+import asyncio
+import codecs
+import threading
+import time
+from collections import OrderedDict
+
+from css import CSSParser
+from scheduler import RENDER_BLOCKING, SCHEDULER
+from url import (FETCH_TIMEOUT, MAX_CONNECTIONS_PER_HOST, SNIFF_BYTES, URL,
+                 content_charset, decode_body, parse_cache_control,
+                 sniff_charset)
+
+MEMORY_CACHE_SIZE = 16 * 1024 * 1024 # bytes
+
+# An in-memory LRU cache shared by every tab, evicting by byte budget
+class MemoryCache:
+  def __init__(self, max_size=MEMORY_CACHE_SIZE):
+    self.max_size = max_size
+    self.size = 0
+    self.entries = OrderedDict() # key -> (value, size, expires)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and entry[2] < time.monotonic():
+        self.remove(key)
+        entry = None
+      if not entry:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  # Whether key has a live entry, without counting a hit or a miss
+  def __contains__(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      return bool(entry) and entry[2] >= time.monotonic()
+
+  def put(self, key, value, size, ttl):
+    with self.lock:
+      self.remove(key)
+      if size > self.max_size:
+        return
+      self.entries[key] = (value, size, time.monotonic() + ttl)
+      self.size += size
+      while self.size > self.max_size:
+        oldest = next(iter(self.entries))
+        self.remove(oldest)
+        self.evictions += 1
+
+  def remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry:
+      self.size -= entry[1]
+
+  def invalidate(self, key):
+    with self.lock:
+      self.remove(key)
+
+  # Drops every entry whose key matches, like everything from one site
+  def invalidate_matching(self, matches):
+    with self.lock:
+      for key in [key for key in self.entries if matches(key)]:
+        self.remove(key)
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "hit_rate": self.hits / lookups if lookups else 0,
+        "entries": len(self.entries),
+        "size": self.size,
+      }
+
+
+MEMORY_CACHE = MemoryCache()
+
+def memory_ttl(headers):
+  cache_control = parse_cache_control(headers.get("cache-control", ""))
+  if "no-store" in cache_control or "no-cache" in cache_control:
+    return 0
+  if "max-age" in cache_control:
+    try:
+      return int(cache_control["max-age"])
+    except ValueError:
+      return 0
+  # like the disk cache, nothing is fresh without an explicit max-age
+  return 0
+
+# Returns the URL that url ends up at after redirects, and an async
+# generator of its body as text, chunk by chunk as it is downloaded
+async def open_text(url, payload=None):
+  key = ("body", url)
+  if payload:
+    # a POST may change what any page of the site returns
+    origin = (url.scheme, url.host, url.port)
+    MEMORY_CACHE.invalidate_matching(
+      lambda key: (key[1].scheme, key[1].host, key[1].port) == origin)
+  else:
+    cached = MEMORY_CACHE.get(key)
+    if cached:
+      body, ttl, final_url = cached
+      return final_url, cached_text(body)
+
+  response = await asyncio.wait_for(url.open_async(payload), FETCH_TIMEOUT)
+  return response.url, decode_text(response, None if payload else key)
+
+async def cached_text(body):
+  yield body
+
+# Yields the chunks, giving up with a TimeoutError on a body that stalls
+# for longer than timeout between two of them. One deadline is pushed back
+# as chunks arrive, and suspended while the caller works on a chunk.
+async def stall_limited(chunks, timeout):
+  loop = asyncio.get_running_loop()
+  try:
+    async with asyncio.timeout(timeout) as deadline:
+      while True:
+        try:
+          chunk = await anext(chunks)
+        except StopAsyncIteration:
+          return
+        deadline.reschedule(None)
+        yield chunk
+        deadline.reschedule(loop.time() + timeout)
+  finally:
+    await chunks.aclose()
+
+# Decodes the body as it arrives. Without a charset in Content-Type, the
+# first SNIFF_BYTES are held back to look for a <meta charset>. A body that
+# stops arriving for FETCH_TIMEOUT is given up on.
+async def decode_text(response, key):
+  decoder = None
+  prefix = bytearray()
+  parts = []
+  async for chunk in stall_limited(response.chunks(), FETCH_TIMEOUT):
+    if not decoder:
+      # a first chunk big enough to sniff is decoded without copying it
+      if prefix or len(chunk) < SNIFF_BYTES:
+        prefix += chunk
+        chunk = prefix
+      if len(chunk) < SNIFF_BYTES and not content_charset(response.headers):
+        continue
+      charset = sniff_charset(response.headers, chunk)
+      decoder = codecs.getincrementaldecoder(charset)("replace")
+    text = decoder.decode(chunk)
+    if text:
+      parts.append(text)
+      yield text
+  if decoder:
+    text = decoder.decode(b"", final=True)
+  else:
+    text = str(prefix, sniff_charset(response.headers, prefix), "replace")
+  if text:
+    parts.append(text)
+    yield text
+
+  ttl = memory_ttl(response.headers)
+  if key and ttl > 0:
+    body = "".join(parts)
+    MEMORY_CACHE.put(key, (body, ttl, response.url), len(body), ttl)
+
+# Starts fetching each stylesheet for owner and returns a future of its
+# parsed rules per url. Sheets missing from the memory cache are grouped by
+# origin. Each sheet gets its own request, unless the origin is known to
+# keep connections open: then they are dealt out over up to
+# MAX_CONNECTIONS_PER_HOST batches, each pipelined on its own connection,
+# so only pages with more sheets than connections queue more than one
+# request on a connection. A sheet that fails to load has no rules.
+def fetch_stylesheets(urls, owner):
+  loop = asyncio.get_running_loop()
+  futures = []
+  groups = {}
+  for url in urls:
+    future = loop.create_future()
+    futures.append(future)
+    rules = MEMORY_CACHE.get(("rules", url))
+    if rules is not None:
+      future.set_result(rules)
+      continue
+    origin = (url.scheme, url.host, url.port)
+    groups.setdefault(origin, []).append((url, future))
+  for origin, group in groups.items():
+    count = len(group)
+    if origin in URL._async_connections.persistent:
+      count = min(count, MAX_CONNECTIONS_PER_HOST)
+    for i in range(count):
+      batch = group[i::count]
+      SCHEDULER.track(owner, asyncio.ensure_future(fetch_stylesheet_batch(batch)))
+  return futures
+
+async def fetch_stylesheet_batch(batch):
+  host = batch[0][0].host
+  try:
+    async with SCHEDULER.slot(host, RENDER_BLOCKING):
+      responses = await URL.fetch_all([url for url, future in batch])
+  except asyncio.CancelledError:
+    for url, future in batch:
+      future.cancel()
+    raise
+  except Exception as e:
+    responses = [e] * len(batch)
+  for (url, future), response in zip(batch, responses):
+    if future.done():
+      continue
+    if isinstance(response, Exception):
+      print("Stylesheet failed:", str(url), repr(response))
+      future.set_result([])
+      continue
+    body = decode_body(response.headers, response.body)
+    rules = CSSParser(body).parse()
+    ttl = memory_ttl(response.headers)
+    if ttl > 0:
+      MEMORY_CACHE.put(("body", url), (body, ttl, response.url), len(body), ttl)
+      MEMORY_CACHE.put(("rules", url), rules, len(body), ttl)
+    future.set_result(rules)
@@ -0,0 +1,220 @@
+import array
+import itertools
+
+from parser import NO_CHILDREN, Element, HTMLParser, Text
+
+NO_NODE = -1
+TEXT = -1 # tag id of a text node
+NO_ATTRIBUTES = -1
+
+# A document stored as parallel arrays indexed by node number instead of an
+# object per node, for pages too big to hold as Elements and Texts. The
+# tree is threaded through first-child and next-sibling links, text nodes
+# are offsets into one string holding all the text, and elements point at
+# a table of distinct attribute lists, which pages repeat a lot. Computed
+# styles, focus and attributes changed after parsing live in dictionaries
+# on the side.
+class CompactDOM:
+  def __init__(self):
+    self.tag_ids = array.array("i")
+    self.parents = array.array("i")
+    self.first_child = array.array("i")
+    self.last_child = array.array("i")
+    self.next_sibling = array.array("i")
+    self.text_start = array.array("i")
+    self.text_length = array.array("i")
+    self.attribute_ids = array.array("i")
+    self.tags = [] # tag id -> name
+    self.tag_index = {} # name -> tag id
+    self.attribute_lists = [] # attribute id -> (name, value, name, ...)
+    self.attribute_index = {} # attribute list -> attribute id
+    self.attributes = {} # node -> attributes, once changed after parsing
+    self.styles = {} # node -> style, set by css.style
+    self.focused = set()
+    self.text = ""
+    self.pieces = [] # text not yet joined onto self.text
+    self.text_size = 0
+
+  def __len__(self):
+    return len(self.tag_ids)
+
+  def add(self, tag_id, parent, text_start, text_length, attribute_id):
+    index = len(self.tag_ids)
+    self.tag_ids.append(tag_id)
+    self.parents.append(parent)
+    self.first_child.append(NO_NODE)
+    self.last_child.append(NO_NODE)
+    self.next_sibling.append(NO_NODE)
+    self.text_start.append(text_start)
+    self.text_length.append(text_length)
+    self.attribute_ids.append(attribute_id)
+    if parent != NO_NODE:
+      if self.last_child[parent] == NO_NODE:
+        self.first_child[parent] = index
+      else:
+        self.next_sibling[self.last_child[parent]] = index
+      self.last_child[parent] = index
+    return index
+
+  def add_element(self, tag, attributes, parent):
+    tag_id = self.tag_index.get(tag)
+    if tag_id is None:
+      tag_id = self.tag_index[tag] = len(self.tags)
+      self.tags.append(tag)
+    attribute_id = NO_ATTRIBUTES
+    if attributes:
+      pairs = tuple(itertools.chain.from_iterable(attributes.items()))
+      attribute_id = self.attribute_index.get(pairs)
+      if attribute_id is None:
+        attribute_id = self.attribute_index[pairs] = len(self.attribute_lists)
+        self.attribute_lists.append(pairs)
+    return self.add(tag_id, parent, 0, 0, attribute_id)
+
+  def add_text(self, text, parent):
+    index = self.add(TEXT, parent, self.text_size, len(text), NO_ATTRIBUTES)
+    self.pieces.append(text)
+    self.text_size += len(text)
+    return index
+
+  def join_text(self):
+    if self.pieces:
+      self.text += "".join(self.pieces)
+      self.pieces = []
+
+  def text_of(self, index):
+    self.join_text()
+    start = self.text_start[index]
+    return self.text[start:start + self.text_length[index]]
+
+  def children_of(self, index):
+    child = self.first_child[index]
+    while child != NO_NODE:
+      yield child
+      child = self.next_sibling[child]
+
+  def node(self, index):
+    if self.tag_ids[index] == TEXT:
+      return CompactText(self, index)
+    return CompactElement(self, index)
+
+
+# What CompactText and CompactElement have in common. Proxies are made on
+# demand and hold no state of their own, so two for the same node are equal.
+class CompactNode:
+  __slots__ = ()
+
+  @property
+  def parent(self):
+    parent = self.dom.parents[self.index]
+    return None if parent == NO_NODE else self.dom.node(parent)
+
+  @property
+  def is_focused(self):
+    return self.index in self.dom.focused
+
+  @is_focused.setter
+  def is_focused(self, focused):
+    if focused:
+      self.dom.focused.add(self.index)
+    else:
+      self.dom.focused.discard(self.index)
+
+  @property
+  def style(self):
+    try:
+      return self.dom.styles[self.index]
+    except KeyError:
+      raise AttributeError("style") from None
+
+  @style.setter
+  def style(self, style):
+    self.dom.styles[self.index] = style
+
+  def __eq__(self, other):
+    return isinstance(other, CompactNode) and \
+      self.dom is other.dom and self.index == other.index
+
+  def __hash__(self):
+    return hash((id(self.dom), self.index))
+
+
+class CompactText(CompactNode, Text):
+  __slots__ = ("dom", "index")
+
+  def __init__(self, dom, index):
+    self.dom = dom
+    self.index = index
+
+  @property
+  def text(self):
+    return self.dom.text_of(self.index)
+
+  @property
+  def children(self):
+    return NO_CHILDREN
+
+
+class CompactElement(CompactNode, Element):
+  __slots__ = ("dom", "index")
+
+  def __init__(self, dom, index):
+    self.dom = dom
+    self.index = index
+
+  @property
+  def tag(self):
+    return self.dom.tags[self.dom.tag_ids[self.index]]
+
+  @property
+  def attributes(self):
+    attributes = self.dom.attributes.get(self.index)
+    if attributes is not None:
+      return attributes
+    attribute_id = self.dom.attribute_ids[self.index]
+    pairs = () if attribute_id == NO_ATTRIBUTES \
+      else self.dom.attribute_lists[attribute_id]
+    return Attributes(self.dom, self.index, pairs)
+
+  @property
+  def children(self):
+    return [self.dom.node(child) for child in self.dom.children_of(self.index)]
+
+
+# A copy of an element's attributes, which becomes the element's own once
+# something is set in it, like an <input>'s value
+class Attributes(dict):
+  __slots__ = ("dom", "index")
+
+  def __init__(self, dom, index, pairs):
+    super().__init__(zip(pairs[::2], pairs[1::2]))
+    self.dom = dom
+    self.index = index
+
+  def __setitem__(self, key, value):
+    self.dom.attributes[self.index] = self
+    dict.__setitem__(self, key, value)
+
+
+# Builds a CompactDOM; tree() and close() return proxies for its root
+class CompactHTMLParser(HTMLParser):
+  def __init__(self, body=""):
+    super().__init__(body)
+    self.dom = CompactDOM()
+
+  def new_text(self, text, parent):
+    return self.dom.add_text(text, parent)
+
+  def new_element(self, tag, attributes, parent, children=None):
+    return self.dom.add_element(
+      tag, attributes, NO_NODE if parent is None else parent)
+
+  def tag_of(self, node):
+    return self.dom.tags[self.dom.tag_ids[node]]
+
+  def tree(self):
+    return self.dom.node(self.unfinished[0]) if self.unfinished else None
+
+  def finish(self):
+    root = super().finish()
+    self.dom.join_text()
+    return self.dom.node(root)
@@ -1,9 +1,30 @@
+import argparse
 import tkinter
 
-from browser import Browser
+from archive import Recorder, Replay
+from browser import Browser, Tab
+from dom import CompactHTMLParser
 from url import URL
 
 if __name__ == "__main__":
-  import sys
-  Browser().new_tab(URL(sys.argv[1]))
-  tkinter.mainloop()
\ No newline at end of file
+  parser = argparse.ArgumentParser()
+  parser.add_argument("url")
+  parser.add_argument("--record", metavar="ARCHIVE",
+                      help="save every response to ARCHIVE")
+  parser.add_argument("--replay", metavar="ARCHIVE",
+                      help="serve responses from ARCHIVE, not the network")
+  parser.add_argument("--latency", type=float, default=0,
+                      help="milliseconds added to each replayed response")
+  parser.add_argument("--bandwidth", type=float, default=0,
+                      help="bytes per second for replayed bodies")
+  parser.add_argument("--compact-dom", action="store_true",
+                      help="store pages as arrays, to open very large ones")
+  args = parser.parse_args()
+  if args.record:
+    URL.recorder = Recorder(args.record)
+  if args.replay:
+    URL.replay = Replay(args.replay, args.latency / 1000, args.bandwidth)
+  if args.compact_dom:
+    Tab.parser_class = CompactHTMLParser
+  Browser().new_tab(URL(args.url))
+  tkinter.mainloop()
@@ -1,7 +1,26 @@
+import re
+import sys
+
+DELIMITERS = re.compile("[<>]")
+
+# Insertion modes, named after the HTML spec's
+BEFORE_HTML = "before html"
+BEFORE_HEAD = "before head" # also after </head> or </body>
+IN_HEAD = "in head"
+IN_BODY = "in body"
+
+# Shared by every node that can't have children, instead of an empty list
+# each
+NO_CHILDREN = ()
+
+# Nodes use __slots__ since a large page has hundreds of thousands of them;
+# style is set later, by css.style
 class Text:
+  __slots__ = ("text", "children", "parent", "is_focused", "style")
+
   def __init__(self, text, parent):
     self.text = text
-    self.children = []
+    self.children = NO_CHILDREN
     self.parent = parent # not used in text, but kept for consistency with Element
     self.is_focused = False
 
@@ -10,10 +29,13 @@ class Text:
 
 
 class Element:
-  def __init__(self, tag, attributes, parent):
+  __slots__ = ("tag", "attributes", "children", "parent", "is_focused",
+               "style")
+
+  def __init__(self, tag, attributes, parent, children=None):
     self.tag = tag
     self.attributes = attributes
-    self.children = []
+    self.children = [] if children is None else children
     self.parent = parent
     self.is_focused = False
 
@@ -38,35 +60,57 @@ class HTMLParser:
       "link", "meta", "title", "style", "script",
   ]
 
-  def __init__(self, body):
+  def __init__(self, body=""):
     self.body = body
     self.unfinished = []
+    self.pending = [] # pieces of the text or tag the last feed ended inside
+    self.in_tag = False
 
   def parse(self):
-    text = "" 
-    in_tag = False
-    for c in self.body:
-      if c == "<":
-        in_tag = True
+    self.feed(self.body)
+    return self.close()
+
+  # Parses another piece of the document, which may end partway through a
+  # tag or text. Between feeds, tree() is the document so far.
+  #
+  # Jumps from one < or > to the next, slicing out the text or tag between
+  # them. Whatever precedes a < is text and whatever precedes a > is a tag,
+  # even outside angle brackets.
+  def feed(self, chunk):
+    start = 0
+    for match in DELIMITERS.finditer(chunk):
+      text = chunk[start:match.start()]
+      if self.pending:
+        self.pending.append(text)
+        text = "".join(self.pending)
+        self.pending = []
+      if match.group() == "<":
+        self.in_tag = True
         if text: self.add_text(text)
-        text = ""
-      elif c == ">":
-        in_tag = False
-        self.add_tag(text)
-        text = ""
       else:
-        text += c
-    if not in_tag and text:
+        self.in_tag = False
+        self.add_tag(text)
+      start = match.end()
+    if start < len(chunk):
+      self.pending.append(chunk[start:])
+
+  # Ends the document and returns its root; text after a final unclosed <
+  # is dropped
+  def close(self):
+    text = "".join(self.pending)
+    self.pending = []
+    if not self.in_tag and text:
         self.add_text(text)
     return self.finish()
+
+  def tree(self):
+    return self.unfinished[0] if self.unfinished else None
   
   def add_text(self, text):
     if text.isspace():
       return
     self.implicit_tags(None)
-    parent = self.unfinished[-1]
-    node = Text(text, parent)
-    parent.children.append(node)
+    self.new_text(text, self.unfinished[-1])
 
   def add_tag(self, tag):
     tag, attributes = self.get_attributes(tag)
@@ -76,45 +120,70 @@ class HTMLParser:
     if tag.startswith("/"): # closing tag
       if len(self.unfinished) == 1: 
         return
-      node = self.unfinished.pop()
-      parent = self.unfinished[-1]
-      parent.children.append(node)
+      self.unfinished.pop()
     elif tag in self.SELF_CLOSING_TAGS: 
-      parent = self.unfinished[-1]
-      node = Element(tag, attributes, parent)
-      parent.children.append(node)
+      self.new_element(tag, attributes, self.unfinished[-1], NO_CHILDREN)
     else: # opening tag
       parent = self.unfinished[-1] if self.unfinished else None
-      node = Element(tag, attributes, parent)
-      self.unfinished.append(node)
+      self.unfinished.append(self.new_element(tag, attributes, parent))
+
+  # Nodes are made and attached to their parent only through these three,
+  # so a subclass can store the tree some other way (see dom.py)
+  def new_text(self, text, parent):
+    node = Text(text, parent)
+    parent.children.append(node)
+    return node
+
+  def new_element(self, tag, attributes, parent, children=None):
+    node = Element(tag, attributes, parent, children)
+    # attached right away, so a partly parsed document is a whole tree
+    if parent:
+      parent.children.append(node)
+    return node
+
+  def tag_of(self, node):
+    return node.tag
   
+  # Tag and attribute names are interned, so every <p> shares one "p"
   def get_attributes(self, text):
     parts = text.split()
-    tag = parts[0].casefold()
+    tag = sys.intern(parts[0].casefold())
     attributes = {}
     for attrpair in parts[1:]:
       if "=" in attrpair:
         key, value = attrpair.split("=", 1)
         if len(value) > 2 and value[0] in ["'", "\""]:
           value = value[1:-1]
-        attributes[key.casefold()] = value
+        attributes[sys.intern(key.casefold())] = value
       else:
-        attributes[attrpair.casefold()] = ""
+        attributes[sys.intern(attrpair.casefold())] = ""
     return tag, attributes
 
+  # The insertion mode follows from the open elements alone: the root is
+  # always <html>, so only how many are open, and whether the second is
+  # <head>, matters. Anything deeper is in the body.
+  def insertion_mode(self):
+    depth = len(self.unfinished)
+    if depth == 0:
+      return BEFORE_HTML
+    elif depth == 1:
+      return BEFORE_HEAD
+    elif depth == 2 and self.tag_of(self.unfinished[1]) == "head":
+      return IN_HEAD
+    else:
+      return IN_BODY
+
   def implicit_tags(self, tag):
     while True:
-      open_tags = [node.tag for node in self.unfinished]
-      if open_tags == [] and tag != "html":
+      mode = self.insertion_mode()
+      if mode == BEFORE_HTML and tag != "html":
         self.add_tag("html")
-      elif open_tags == ["html"] \
-        and tag not in ["head", "body", "/html"]:
+      elif mode == BEFORE_HEAD and tag not in ["head", "body", "/html"]:
         if tag in self.HEAD_TAGS:
           self.add_tag("head")
         else:
           self.add_tag("body")
-      elif open_tags == ["html", "head"] and \
-          tag not in ["/head"] + self.HEAD_TAGS:
+      elif mode == IN_HEAD and tag != "/head" and tag not in self.HEAD_TAGS:
         self.add_tag("/head")
       else:
         break
@@ -123,7 +192,5 @@ class HTMLParser:
     if not self.unfinished:
       self.implicit_tags(None)
     while len(self.unfinished) > 1:
-      node = self.unfinished.pop()
-      parent = self.unfinished[-1]
-      parent.children.append(node)
+      self.unfinished.pop()
     return self.unfinished.pop()
\ No newline at end of file
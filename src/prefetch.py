@@ -0,0 +1,75 @@
+from cache import MEMORY_CACHE, open_text
+from scheduler import PREFETCH, SCHEDULER
+
+PREFETCH_BUDGET = 2 * 1024 * 1024 # characters of text prefetched per page
+
+# Fetches pages the user is likely to open next into the memory cache, so
+# following the link is served from memory. Each page gets a fresh budget;
+# a prefetch that would overrun it is dropped. Counts how many prefetched
+# pages end up being opened, to tune what is worth fetching.
+class Prefetcher:
+  def __init__(self, budget=PREFETCH_BUDGET):
+    self.budget = budget
+    self.spent = 0
+    self.seen = set() # urls considered for the current page
+    self.fetched = set() # urls prefetched and not yet opened
+    self.requested = 0
+    self.prefetched = 0
+    self.bytes = 0
+    self.hits = 0
+    self.over_budget = 0
+    self.uncacheable = 0
+    self.failed = 0
+
+  def reset(self):
+    self.spent = 0
+    self.seen = set()
+
+  def wants(self, url):
+    if url in self.seen or self.spent >= self.budget:
+      return False
+    self.seen.add(url)
+    return ("body", url) not in MEMORY_CACHE
+
+  async def fetch(self, url):
+    self.requested += 1
+    size = 0
+    try:
+      async with SCHEDULER.slot(url.host, PREFETCH):
+        final_url, chunks = await open_text(url)
+        async for text in chunks:
+          size += len(text)
+          if self.spent + size > self.budget:
+            await chunks.aclose()
+            self.over_budget += 1
+            return
+    except Exception as e:
+      print("Prefetch failed:", str(url), repr(e))
+      self.failed += 1
+      return
+    self.spent += size
+    # a response the memory cache won't keep is no use to prefetch
+    if ("body", url) not in MEMORY_CACHE:
+      self.uncacheable += 1
+      return
+    self.bytes += size
+    self.prefetched += 1
+    self.fetched.add(url)
+
+  # Called on every navigation
+  def opened(self, url):
+    if url in self.fetched:
+      self.fetched.discard(url)
+      self.hits += 1
+
+  def stats(self):
+    return {
+      "requested": self.requested,
+      "prefetched": self.prefetched,
+      "bytes": self.bytes,
+      "hits": self.hits,
+      "hit_rate": self.hits / self.prefetched if self.prefetched else 0,
+      "over_budget": self.over_budget,
+      "uncacheable": self.uncacheable,
+      "failed": self.failed,
+    }
@@ -0,0 +1,102 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+
+from url import MAX_CONNECTIONS_PER_HOST
+
+# Priority classes, most urgent first
+NAVIGATION = 0
+RENDER_BLOCKING = 1
+PREFETCH = 2
+
+MAX_IN_FLIGHT = 16 # requests running at once across all hosts
+
+# Hands out request slots in priority order, so a page's own document and
+# stylesheets never queue behind speculative work, while keeping the
+# number of requests in flight under a global and a per-host cap. Tasks
+# are tracked per owner (a tab) so they can all be cancelled when the
+# owner navigates somewhere else.
+class RequestScheduler:
+  def __init__(self, max_in_flight=MAX_IN_FLIGHT,
+               max_per_host=MAX_CONNECTIONS_PER_HOST):
+    self.max_in_flight = max_in_flight
+    self.max_per_host = max_per_host
+    self.waiting = [] # heap of (priority, seq, host, future)
+    self.seq = itertools.count()
+    self.in_flight = {} # host -> requests running
+    self.total = 0
+    self.tasks = {} # owner -> set of tasks
+    self.granted = 0
+    self.cancelled = 0
+
+  async def acquire(self, host, priority):
+    future = asyncio.get_running_loop().create_future()
+    heapq.heappush(self.waiting, (priority, next(self.seq), host, future))
+    self.dispatch()
+    try:
+      await future
+    except asyncio.CancelledError:
+      # the slot may have been granted just as the waiter was cancelled
+      if future.done() and not future.cancelled():
+        self.release(host)
+      raise
+
+  def release(self, host):
+    self.in_flight[host] -= 1
+    if not self.in_flight[host]:
+      del self.in_flight[host]
+    self.total -= 1
+    self.dispatch()
+
+  # Grants waiting requests in priority order while there is room. A
+  # request whose host is at its cap doesn't hold up other hosts.
+  def dispatch(self):
+    blocked = []
+    while self.waiting and self.total < self.max_in_flight:
+      entry = heapq.heappop(self.waiting)
+      priority, seq, host, future = entry
+      if future.done():
+        continue
+      if self.in_flight.get(host, 0) >= self.max_per_host:
+        blocked.append(entry)
+        continue
+      self.in_flight[host] = self.in_flight.get(host, 0) + 1
+      self.total += 1
+      self.granted += 1
+      future.set_result(None)
+    for entry in blocked:
+      heapq.heappush(self.waiting, entry)
+
+  @contextlib.asynccontextmanager
+  async def slot(self, host, priority):
+    await self.acquire(host, priority)
+    try:
+      yield
+    finally:
+      self.release(host)
+
+  def track(self, owner, task):
+    tasks = self.tasks.setdefault(owner, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+  # Cancels every task owner started, whether it is still waiting for a
+  # slot or already downloading
+  def cancel(self, owner):
+    for task in self.tasks.pop(owner, ()):
+      if task.cancel():
+        self.cancelled += 1
+
+  def stats(self):
+    return {
+      "in_flight": self.total,
+      "hosts": dict(self.in_flight),
+      "waiting": sum(1 for entry in self.waiting if not entry[3].done()),
+      "granted": self.granted,
+      "cancelled": self.cancelled,
+    }
+
+
+SCHEDULER = RequestScheduler()
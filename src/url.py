@@ -1,80 +1,1211 @@
+import asyncio
+import base64
+import codecs
+import contextvars
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import re
+import select
 import socket
 import ssl
+import threading
+import time
+import urllib.parse
+import zlib
 
-class URL:
-  def __init__(self, url):
-    self.scheme, url = url.split("://", 1)
-    if self.scheme == "http":
-      self.port = 80
-    elif self.scheme == "https":
-      self.port = 443
-
-    if "/" not in url:
-      url = url + "/"
-    self.host, url = url.split("/", 1)
-    self.path = "/" + url
-
-    if ":" in self.host:
-      self.host, port = self.host.split(":", 1)
-      self.port = int(port)
+MAX_CONNECTIONS_PER_HOST = 6
+IDLE_TIMEOUT = 30 # seconds an idle keep-alive connection is kept around
+CHUNK_SIZE = 16 * 1024
+FETCH_TIMEOUT = 30 # seconds for a whole URL.fetch()
+DNS_TTL = 60 # seconds a resolved address is reused
+DNS_NEGATIVE_TTL = 10 # seconds a failed lookup is remembered
 
-  def __str__(self):
-    port_part = ":" + str(self.port)
-    if self.scheme == "https" and self.port == 443:
-      port_part = ""
-    if self.scheme == "http" and self.port == 80:
-      port_part = ""
-    return self.scheme + "://" + self.host + port_part + self.path
-  
-  
-  def request(self, payload=None):
+# Caches getaddrinfo results, including failures. Lookups can also be
+# started early on a background thread so a later request finds them ready.
+class Resolver:
+  def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.entries = {} # host -> (expires, address or exception)
+    self.pending = set()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def lookup(self, host):
+    with self.lock:
+      entry = self.entries.get(host)
+      if entry and entry[0] > time.monotonic():
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+      return None
+
+  def resolve(self, host):
+    result = self.lookup(host)
+    if result is None:
+      result = self.query(host)
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  async def resolve_async(self, host):
+    result = self.lookup(host)
+    if result is None:
+      loop = asyncio.get_running_loop()
+      result = await loop.run_in_executor(None, self.query, host)
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def query(self, host):
+    try:
+      infos = socket.getaddrinfo(host, None,
+        family=socket.AF_INET, type=socket.SOCK_STREAM)
+      result, ttl = infos[0][4][0], self.ttl
+    except socket.gaierror as e:
+      result, ttl = e, self.negative_ttl
+    with self.lock:
+      self.entries[host] = (time.monotonic() + ttl, result)
+      self.pending.discard(host)
+    return result
+
+  def prefetch(self, host):
+    with self.lock:
+      entry = self.entries.get(host)
+      if host in self.pending or (entry and entry[0] > time.monotonic()):
+        return
+      self.pending.add(host)
+    threading.Thread(target=self.query, args=(host,), daemon=True).start()
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0,
+        "entries": len(self.entries),
+      }
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wbe-browser")
+CACHE_SIZE = 50 * 1024 * 1024 # bytes of response bodies kept on disk
+MAX_REDIRECTS = 5
+MAX_PIPELINE_DEPTH = 6 # requests sent ahead on one connection
+MAX_HEAD_SIZE = 64 * 1024 # bytes of status line and headers
+DEFAULT_CHARSET = "utf-8"
+SNIFF_BYTES = 1024 # how far into a body to look for <meta charset>
+MAX_REDIRECT_ENTRIES = 1000
+LOCAL_SCHEMES = ("file", "data") # loaded without the network
+MAX_INTERNED_URLS = 4096
+MAX_RESOLVED_URLS = 4096 # (base, href) pairs remembered by URL.resolve
+
+# The session an asyncio connection is about to resume, see TLSContext
+RESUME_SESSION = contextvars.ContextVar("resume_session", default=None)
+
+# asyncio's start_tls can't be given an SSLSession, but it does make its
+# SSLObject with wrap_bio, in the task doing the handshake, so the session
+# is passed on through RESUME_SESSION
+class TLSContext(ssl.SSLContext):
+  def wrap_bio(self, incoming, outgoing, server_side=False,
+               server_hostname=None, session=None):
+    return super().wrap_bio(incoming, outgoing, server_side, server_hostname,
+                            session or RESUME_SESSION.get())
+
+
+# One SSLContext for the whole process, so the CA store is loaded once,
+# plus the last TLS session per host so new connections can resume it.
+class TLSSessions:
+  def __init__(self):
+    self.ctx = None
+    self.sessions = {} # (host, port) -> ssl.SSLSession
+    self.lock = threading.Lock()
+    self.resumed = 0
+    self.full_handshakes = 0
+
+  def context(self):
+    with self.lock:
+      if not self.ctx:
+        # what ssl.create_default_context sets up for a client
+        self.ctx = TLSContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ctx.load_default_certs()
+      return self.ctx
+
+  def wrap(self, s, host, port):
+    session = self.sessions.get((host, port))
+    return self.context().wrap_socket(
+      s, server_hostname=host, session=session)
+
+  async def start_tls(self, writer, host, port):
+    token = RESUME_SESSION.set(self.sessions.get((host, port)))
+    try:
+      await writer.start_tls(self.context(), server_hostname=host)
+    finally:
+      RESUME_SESSION.reset(token)
+    self.connected(writer.get_extra_info("ssl_object"))
+
+  def connected(self, s):
+    with self.lock:
+      if s.session_reused:
+        self.resumed += 1
+      else:
+        self.full_handshakes += 1
+
+  # With TLS 1.3 the session ticket arrives after the handshake, so this
+  # is called once a response has been read.
+  def save(self, s, host, port):
+    session = s.session
+    if session:
+      with self.lock:
+        self.sessions[(host, port)] = session
+
+
+class Connection:
+  def __init__(self, scheme, host, port):
+    self.key = (scheme, host, port)
     s = socket.socket(
       family=socket.AF_INET,
       type=socket.SOCK_STREAM,
       proto=socket.IPPROTO_TCP,
     )
-    if self.scheme == "https":
-      ctx = ssl.create_default_context()
-      s = ctx.wrap_socket(s, server_hostname=self.host)
+    start = time.perf_counter()
+    address = URL.resolver.resolve(host)
+    resolved = time.perf_counter()
+    s.connect((address, port))
+    connected = time.perf_counter()
+    if scheme == "https":
+      s = URL.tls.wrap(s, host, port)
+      URL.tls.connected(s)
+    self.setup = setup_timing(start, resolved, connected, scheme)
+    self.socket = s
+    self.file = s.makefile("rb")
+    self.reused = False
+    self.last_used = time.monotonic()
+
+  def send(self, data):
+    self.socket.sendall(data)
+
+  def is_stale(self, idle_timeout):
+    if time.monotonic() - self.last_used > idle_timeout:
+      return True
+    # An idle connection has nothing to read, so a readable socket means
+    # the server closed it (or sent garbage) and it can't be reused.
+    try:
+      readable, _, _ = select.select([self.socket], [], [], 0)
+    except (OSError, ValueError):
+      return True
+    return bool(readable)
+
+  def save_session(self):
+    if isinstance(self.socket, ssl.SSLSocket):
+      scheme, host, port = self.key
+      URL.tls.save(self.socket, host, port)
+
+  def close(self):
+    try:
+      self.file.close()
+      self.socket.close()
+    except OSError:
+      pass
+
+
+# Keep-alive connections keyed by (scheme, host, port)
+class ConnectionPool:
+  def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST,
+               idle_timeout=IDLE_TIMEOUT):
+    self.max_per_host = max_per_host
+    self.idle_timeout = idle_timeout
+    self.idle = {}
+    self.in_use = {}
+    self.lock = threading.Condition()
+
+  def acquire(self, scheme, host, port):
+    key = (scheme, host, port)
+    with self.lock:
+      while True:
+        idle = self.idle.get(key, [])
+        while idle:
+          conn = idle.pop()
+          if conn.is_stale(self.idle_timeout):
+            conn.close()
+            continue
+          conn.reused = True
+          self.in_use[key] = self.in_use.get(key, 0) + 1
+          return conn
+        if self.in_use.get(key, 0) < self.max_per_host:
+          self.in_use[key] = self.in_use.get(key, 0) + 1
+          break
+        self.lock.wait()
+
+    # connect outside the lock so other hosts aren't blocked
+    try:
+      return Connection(scheme, host, port)
+    except:
+      self.done(key)
+      raise
+
+  def release(self, conn):
+    conn.last_used = time.monotonic()
+    with self.lock:
+      self.idle.setdefault(conn.key, []).append(conn)
+    self.done(conn.key)
+
+  def discard(self, conn):
+    conn.close()
+    self.done(conn.key)
+
+  def done(self, key):
+    with self.lock:
+      self.in_use[key] -= 1
+      self.lock.notify_all()
+
+  def close_all(self):
+    with self.lock:
+      for conns in self.idle.values():
+        for conn in conns:
+          conn.close()
+      self.idle.clear()
+
+
+class AsyncConnection:
+  def __init__(self, key, reader, writer):
+    self.key = key
+    self.reader = reader
+    self.writer = writer
+    self.loop = asyncio.get_running_loop()
+    self.reused = False
+    self.last_used = time.monotonic()
+
+  @classmethod
+  async def connect(cls, scheme, host, port):
+    start = time.perf_counter()
+    address = await URL.resolver.resolve_async(host)
+    resolved = time.perf_counter()
+    reader, writer = await asyncio.open_connection(
+      address, port, limit=MAX_HEAD_SIZE)
+    connected = time.perf_counter()
+    if scheme == "https":
+      await URL.tls.start_tls(writer, host, port)
+    conn = cls((scheme, host, port), reader, writer)
+    conn.setup = setup_timing(start, resolved, connected, scheme)
+    return conn
+
+  async def send(self, data):
+    self.writer.write(data)
+    await self.writer.drain()
+
+  def save_session(self):
+    ssl_object = self.writer.get_extra_info("ssl_object")
+    if ssl_object:
+      scheme, host, port = self.key
+      URL.tls.save(ssl_object, host, port)
+
+  def is_stale(self, idle_timeout):
+    return time.monotonic() - self.last_used > idle_timeout \
+      or self.reader.at_eof() or self.writer.is_closing() \
+      or self.loop is not asyncio.get_running_loop()
+
+  def close(self):
+    try:
+      self.writer.close()
+    except (OSError, RuntimeError): # RuntimeError if its loop is closed
+      pass
+
+
+# The asyncio counterpart of ConnectionPool. Everything runs on one event
+# loop, so no locking is needed.
+class AsyncConnectionPool:
+  def __init__(self, idle_timeout=IDLE_TIMEOUT):
+    self.idle_timeout = idle_timeout
+    self.idle = {}
+    self.persistent = set() # origins that kept an HTTP/1.1 connection open
+
+  async def acquire(self, scheme, host, port):
+    idle = self.idle.get((scheme, host, port), [])
+    while idle:
+      conn = idle.pop()
+      if conn.is_stale(self.idle_timeout):
+        conn.close()
+        continue
+      conn.reused = True
+      return conn
+    return await AsyncConnection.connect(scheme, host, port)
+
+  def release(self, conn):
+    conn.last_used = time.monotonic()
+    self.idle.setdefault(conn.key, []).append(conn)
+
+  def discard(self, conn):
+    conn.close()
+
+  def close_all(self):
+    for conns in self.idle.values():
+      for conn in conns:
+        conn.close()
+    self.idle.clear()
+
+
+# Undoes Content-Encoding one chunk at a time
+class ContentDecoder:
+  def __init__(self, encoding):
+    self.encoding = encoding.casefold()
+    self.started = False
+    if self.encoding in ("gzip", "x-gzip"):
+      self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif self.encoding == "deflate":
+      self.decoder = zlib.decompressobj(zlib.MAX_WBITS)
+    elif self.encoding == "identity":
+      self.decoder = None
+    else:
+      raise ValueError("unsupported content-encoding: " + encoding)
+
+  def decompress(self, chunk):
+    if not self.decoder:
+      return chunk
+    first = not self.started
+    self.started = True
+    try:
+      return self.decoder.decompress(chunk)
+    except zlib.error:
+      # Some servers send raw deflate data without the zlib header
+      if self.encoding != "deflate" or not first:
+        raise
+      self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+      return self.decoder.decompress(chunk)
+
+  def flush(self):
+    return self.decoder.flush() if self.decoder else b""
+
+
+# A response whose body is streamed off the connection as it arrives. The
+# connection goes back to the pool once the body has been read to the end.
+class Response:
+  def __init__(self, conn, version, status, explanation, headers):
+    self.conn = conn
+    self.version = version
+    self.status = status
+    self.explanation = explanation
+    self.headers = headers
+    self.keep_alive = is_keep_alive(version, headers)
+    self.done = False
+    # body bytes as sent on the wire vs. after content decoding
+    self.bytes_received = 0
+    self.bytes_decoded = 0
+    self.from_cache = False
+    self.on_body = [] # called with the whole body once it has arrived
+    self.timing = {}
+    self.head_received = time.perf_counter()
+    # a pipelined response leaves its connection to URL.fetch_all, which
+    # still has more responses to read from it
+    self.pipelined = False
+
+  def body_reader(self):
+    file = self.conn.file
+    framing = self.framing()
+    if framing == "empty":
+      return iter(())
+    elif framing == "chunked":
+      return read_chunked(file)
+    elif framing == "length":
+      return read_length(file, int(self.headers["content-length"]))
+    else:
+      return read_until_close(file)
+
+  def framing(self):
+    encoding = self.headers.get("transfer-encoding", "identity").casefold()
+    if self.status in ("204", "304") or self.status.startswith("1"):
+      return "empty"
+    elif encoding == "chunked":
+      return "chunked"
+    elif encoding != "identity":
+      raise ValueError("unsupported transfer-encoding: " + encoding)
+    elif "content-length" in self.headers:
+      return "length"
+    else:
+      # No framing: the body runs until the server closes the connection
+      self.keep_alive = False
+      return "close"
+
+  def decode(self, chunks):
+    decoder = ContentDecoder(self.headers.get("content-encoding", "identity"))
+    for chunk in chunks:
+      self.bytes_received += len(chunk)
+      chunk = decoder.decompress(chunk)
+      if chunk:
+        self.bytes_decoded += len(chunk)
+        yield chunk
+    chunk = decoder.flush()
+    if chunk:
+      self.bytes_decoded += len(chunk)
+      yield chunk
+
+  def chunks(self):
+    assert not self.done, "response body already consumed"
+    self.done = True
+    body = bytearray() if self.on_body else None
+    try:
+      for chunk in self.decode(self.body_reader()):
+        if body is not None:
+          body += chunk
+        yield chunk
+    except BaseException:
+      # includes GeneratorExit when the reader is abandoned half way
+      URL._connections.discard(self.conn)
+      raise
+    self.finish_timing()
+    self.conn.save_session()
+    if self.keep_alive:
+      URL._connections.release(self.conn)
+    else:
+      URL._connections.discard(self.conn)
+    for callback in self.on_body:
+      callback(bytes(body))
+
+  def read(self):
+    return b"".join(self.chunks())
+
+  def finish_timing(self):
+    self.timing["download"] = ms(time.perf_counter() - self.head_received)
+    self.timing["bytes_received"] = self.bytes_received
+    self.timing["bytes_decoded"] = self.bytes_decoded
+
+  def close(self):
+    if not self.done:
+      self.done = True
+      URL._connections.discard(self.conn)
+
+
+# A Response read with asyncio; chunks() is an async generator
+class AsyncResponse(Response):
+  def body_reader(self):
+    reader = self.conn.reader
+    framing = self.framing()
+    if framing == "empty":
+      return read_nothing_async()
+    elif framing == "chunked":
+      return read_chunked_async(reader)
+    elif framing == "length":
+      return read_length_async(reader, int(self.headers["content-length"]))
+    else:
+      return read_until_close_async(reader)
+
+  async def decode(self, chunks):
+    decoder = ContentDecoder(self.headers.get("content-encoding", "identity"))
+    async for chunk in chunks:
+      self.bytes_received += len(chunk)
+      chunk = decoder.decompress(chunk)
+      if chunk:
+        self.bytes_decoded += len(chunk)
+        yield chunk
+    chunk = decoder.flush()
+    if chunk:
+      self.bytes_decoded += len(chunk)
+      yield chunk
+
+  async def chunks(self):
+    assert not self.done, "response body already consumed"
+    self.done = True
+    body = bytearray() if self.on_body else None
+    try:
+      async for chunk in self.decode(self.body_reader()):
+        if body is not None:
+          body += chunk
+        yield chunk
+    except BaseException:
+      # includes CancelledError when the fetch times out or is cancelled
+      URL._async_connections.discard(self.conn)
+      raise
+    self.finish_timing()
+    self.conn.save_session()
+    if self.pipelined:
+      pass
+    elif self.keep_alive:
+      if self.version == "HTTP/1.1":
+        URL._async_connections.persistent.add(self.conn.key)
+      URL._async_connections.release(self.conn)
+    else:
+      URL._async_connections.discard(self.conn)
+    for callback in self.on_body:
+      callback(bytes(body))
+
+  async def read(self):
+    self.body = b"".join([chunk async for chunk in self.chunks()])
+    return self.body
+
+  def close(self):
+    if not self.done:
+      self.done = True
+      URL._async_connections.discard(self.conn)
+
+
+# A response served from a cache instead of the network
+class CachedResponse:
+  def __init__(self, status, headers, body):
+    self.status = status
+    self.explanation = "OK"
+    self.headers = headers
+    self.body = body
+    self.bytes_received = 0
+    self.bytes_decoded = len(body)
+    self.from_cache = True
+    self.timing = {}
+
+  def chunks(self):
+    for i in range(0, len(self.body), CHUNK_SIZE):
+      yield self.body[i:i + CHUNK_SIZE]
+
+  def read(self):
+    return self.body
+
+  def close(self):
+    pass
+
+
+class AsyncCachedResponse(CachedResponse):
+  async def chunks(self):
+    for chunk in CachedResponse.chunks(self):
+      yield chunk
+
+  async def read(self):
+    return self.body
+
+
+# A file: or data: body. A file's body is a read-only mapping of it, handed
+# out as one view so that decoding it is the only copy ever made.
+class LocalResponse(CachedResponse):
+  def __init__(self, status, headers, body):
+    super().__init__(status, headers, body)
+    self.from_cache = False
+    if status != "200":
+      self.explanation = "Not Found"
+
+  def chunks(self):
+    if self.body:
+      yield memoryview(self.body)
+
+
+class AsyncLocalResponse(LocalResponse):
+  async def chunks(self):
+    for chunk in LocalResponse.chunks(self):
+      yield chunk
+
+  async def read(self):
+    return self.body
+
 
-    s.connect((self.host, self.port))
+# Response bodies stored on disk, with an index.json of their headers and
+# validators. The index keeps entries in least- to most-recently used order.
+class DiskCache:
+  def __init__(self, directory, max_size=CACHE_SIZE):
+    self.directory = directory
+    self.max_size = max_size
+    self.entries = None # loaded on first use
+    self.lock = threading.Lock()
 
+  def load(self):
+    if self.entries is not None:
+      return
+    try:
+      with open(os.path.join(self.directory, "index.json")) as f:
+        self.entries = json.load(f)
+    except (OSError, ValueError):
+      self.entries = {}
+
+  # A cache that can't be written to still works, only for this run
+  def save(self):
+    path = os.path.join(self.directory, "index.json")
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      with open(path + ".tmp", "w") as f:
+        json.dump(self.entries, f)
+      os.replace(path + ".tmp", path)
+    except OSError as e:
+      print("Couldn't save the cache index:", repr(e))
+
+  def body_path(self, url):
+    name = hashlib.sha1(url.encode("utf8")).hexdigest()
+    return os.path.join(self.directory, name)
+
+  def lookup(self, url):
+    with self.lock:
+      self.load()
+      if url not in self.entries:
+        return None
+      try:
+        with open(self.body_path(url), "rb") as f:
+          body = f.read()
+      except OSError:
+        del self.entries[url]
+        return None
+      entry = self.entries.pop(url)
+      self.entries[url] = entry
+      return entry, body
+
+  def is_fresh(self, entry):
+    return time.time() - entry["stored"] < entry["max_age"]
+
+  def store(self, url, status, headers, body):
+    cache_control = parse_cache_control(headers.get("cache-control", ""))
+    with self.lock:
+      self.load()
+      if "no-store" in cache_control or len(body) > self.max_size:
+        if self.remove(url):
+          self.save()
+        return
+      entry = {
+        "status": status,
+        "headers": {k: v for k, v in headers.items()
+                    if k not in UNCACHED_HEADERS},
+        "size": len(body),
+      }
+      set_freshness(entry, headers)
+      if entry["max_age"] <= 0 and "etag" not in entry["headers"] \
+          and "last-modified" not in entry["headers"]:
+        if self.remove(url):
+          self.save()
+        return
+      try:
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.body_path(url), "wb") as f:
+          f.write(body)
+      except OSError as e:
+        # the response is still fine to use, it just isn't cached
+        print("Couldn't cache", url + ":", repr(e))
+        self.remove(url)
+        return
+      self.entries.pop(url, None)
+      self.entries[url] = entry
+      self.evict()
+      self.save()
+
+  # A 304 Not Modified response renews the stored entry
+  def refresh(self, url, headers):
+    with self.lock:
+      self.load()
+      entry = self.entries.get(url)
+      if not entry:
+        return
+      for header, value in headers.items():
+        if header not in UNCACHED_HEADERS:
+          entry["headers"][header] = value
+      set_freshness(entry, entry["headers"])
+      self.save()
+
+  # Whether there was an entry for url to remove
+  def remove(self, url):
+    entry = self.entries.pop(url, None)
+    if entry:
+      try:
+        os.remove(self.body_path(url))
+      except OSError:
+        pass
+    return entry is not None
+
+  def evict(self):
+    total = sum(entry["size"] for entry in self.entries.values())
+    for url in list(self.entries):
+      if total <= self.max_size:
+        break
+      total -= self.entries[url]["size"]
+      self.remove(url)
+
+
+# Remembers 301 and 308 redirects across restarts, so later navigations
+# go straight to the final location
+class RedirectCache:
+  def __init__(self, path, max_entries=MAX_REDIRECT_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    self.targets = None # loaded on first use
+    self.lock = threading.Lock()
+
+  def load(self):
+    if self.targets is not None:
+      return
+    try:
+      with open(self.path) as f:
+        self.targets = json.load(f)
+    except (OSError, ValueError):
+      self.targets = {}
+
+  def follow(self, url):
+    with self.lock:
+      self.load()
+      key = str(url)
+      seen = set()
+      while key in self.targets and key not in seen:
+        seen.add(key)
+        key = self.targets[key]
+    if not seen:
+      return url
+    print("Permanent redirect:", str(url), "->", key)
+    return URL(key)
+
+  def add(self, source, target):
+    with self.lock:
+      self.load()
+      self.targets.pop(source, None)
+      self.targets[source] = target
+      while len(self.targets) > self.max_entries:
+        del self.targets[next(iter(self.targets))]
+      try:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+          json.dump(self.targets, f)
+        os.replace(self.path + ".tmp", self.path)
+      except OSError as e:
+        # the redirect is still remembered until the browser exits
+        print("Couldn't save redirects:", repr(e))
+
+
+# A size-bounded memo table that forgets the least recently used entry
+class Memo:
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = {}
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is None:
+        self.misses += 1
+        return None
+      self.entries[key] = value
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        del self.entries[next(iter(self.entries))]
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0,
+        "entries": len(self.entries),
+      }
+
+
+# URLs are immutable and interned: parsing a string seen before returns
+# the same object, and equal URLs compare and hash alike, so they can be
+# used directly as cache keys.
+class URL:
+  __slots__ = ("scheme", "host", "port", "path", "text", "hash")
+  _interned = Memo(MAX_INTERNED_URLS) # string -> URL
+  _resolved = Memo(MAX_RESOLVED_URLS) # (base URL, href) -> URL
+  _connections = ConnectionPool()
+  _async_connections = AsyncConnectionPool()
+  resolver = Resolver()
+  tls = TLSSessions()
+  cache = DiskCache(CACHE_DIR)
+  redirects = RedirectCache(os.path.join(CACHE_DIR, "redirects.json"))
+  # set by archive.py to record responses to, or replay them from, a file
+  recorder = None
+  replay = None
+
+  def __new__(cls, url):
+    interned = URL._interned.get(url)
+    if interned:
+      return interned
+
+    if url.startswith("data:"):
+      # everything after the scheme is the media type and the data
+      scheme, host, port, path = "data", "", None, url[len("data:"):]
+      text = url
+    else:
+      scheme, rest = url.split("://", 1)
+      port = None
+      if scheme == "http":
+        port = 80
+      elif scheme == "https":
+        port = 443
+
+      if "/" not in rest:
+        rest = rest + "/"
+      host, rest = rest.split("/", 1)
+      path = "/" + rest
+
+      if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+
+      port_part = ":" + str(port)
+      if scheme == "https" and port == 443 or \
+          scheme == "http" and port == 80 or port is None:
+        port_part = ""
+      text = scheme + "://" + host + port_part + path
+
+    # different spellings of one URL share the object for its canonical one
+    self = URL._interned.get(text)
+    if not self:
+      self = object.__new__(cls)
+      for name, value in (("scheme", scheme), ("host", host), ("port", port),
+                          ("path", path), ("text", text), ("hash", hash(text))):
+        object.__setattr__(self, name, value)
+      URL._interned.put(text, self)
+    URL._interned.put(url, self)
+    return self
+
+  def __setattr__(self, name, value):
+    raise AttributeError("URL objects are immutable")
+
+  def __eq__(self, other):
+    return isinstance(other, URL) and self.text == other.text
+
+  def __hash__(self):
+    return self.hash
+
+  def __str__(self):
+    return self.text
+
+  def __repr__(self):
+    return "URL(" + repr(self.text) + ")"
+
+
+  # Follows redirects; the returned response's url is the final location
+  def open(self, payload=None):
+    url = URL.redirects.follow(self) if not payload else self
+    for i in range(MAX_REDIRECTS + 1):
+      if url.scheme in LOCAL_SCHEMES:
+        response = url.open_local(LocalResponse)
+      elif URL.replay:
+        response = URL.replay.open(url, payload)
+      else:
+        response = url.open_cached(payload)
+      if URL.recorder and url.scheme not in LOCAL_SCHEMES:
+        URL.recorder.watch(url, payload, response)
+      log_timing(url, payload, response)
+      location = redirect_location(response)
+      if not location:
+        response.url = url
+        return response
+      response.read() # puts the connection back for the next hop
+      url, payload = url.redirect(response.status, location, payload)
+    raise RuntimeError("too many redirects")
+
+  async def open_async(self, payload=None):
+    url = URL.redirects.follow(self) if not payload else self
+    for i in range(MAX_REDIRECTS + 1):
+      if url.scheme in LOCAL_SCHEMES:
+        response = url.open_local(AsyncLocalResponse)
+      elif URL.replay:
+        response = await URL.replay.open_async(url, payload)
+      else:
+        response = await url.open_cached_async(payload)
+      if URL.recorder and url.scheme not in LOCAL_SCHEMES:
+        URL.recorder.watch(url, payload, response)
+      log_timing(url, payload, response)
+      location = redirect_location(response)
+      if not location:
+        response.url = url
+        return response
+      await response.read()
+      url, payload = url.redirect(response.status, location, payload)
+    raise RuntimeError("too many redirects")
+
+  def open_local(self, response_class):
+    headers = {"cache-control": "no-store"}
+    if self.scheme == "data":
+      media_type, _, data = self.path.partition(",")
+      body = urllib.parse.unquote_to_bytes(data)
+      if media_type.endswith(";base64"):
+        media_type = media_type[:-len(";base64")]
+        body = base64.b64decode(body)
+      headers["content-type"] = media_type or "text/plain;charset=US-ASCII"
+      return response_class("200", headers, body)
+
+    path = urllib.parse.unquote(self.path.split("#")[0].split("?")[0])
+    headers["content-type"] = mimetypes.guess_type(path)[0] or "text/plain"
+    try:
+      with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+          body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+          body = b""
+    except OSError as e:
+      headers["content-type"] = "text/plain"
+      return response_class("404", headers, str(e).encode())
+    return response_class("200", headers, body)
+
+  def redirect(self, status, location, payload):
+    target = self.resolve(location)
+    if not self.can_load(target):
+      raise ValueError("redirect to a local URL: " + str(target))
+    print("Redirecting to:", str(target))
+    if status in ("301", "308"):
+      URL.redirects.add(str(self), str(target))
+    # 307 and 308 repeat the request as is; the others turn it into a GET
+    if status not in ("307", "308"):
+      payload = None
+    return target, payload
+
+  def open_cached(self, payload=None):
+    if payload:
+      return self.http_request(payload)
+    cached = URL.cache.lookup(str(self))
+    if cached and URL.cache.is_fresh(cached[0]):
+      return self.from_cache(cached, CachedResponse)
+    response = self.http_request(None, conditional_headers(cached))
+    if cached and response.status == "304":
+      response.read()
+      return self.revalidated(response, cached, CachedResponse)
+    self.store_when_done(response)
+    return response
+
+  async def open_cached_async(self, payload=None):
+    if payload:
+      return await self.http_request_async(payload)
+    cached = URL.cache.lookup(str(self))
+    if cached and URL.cache.is_fresh(cached[0]):
+      return self.from_cache(cached, AsyncCachedResponse)
+    response = await self.http_request_async(None, conditional_headers(cached))
+    if cached and response.status == "304":
+      await response.read()
+      return self.revalidated(response, cached, AsyncCachedResponse)
+    self.store_when_done(response)
+    return response
+
+  # Like request(), but on the running asyncio loop. Returns the response
+  # with its whole body in response.body.
+  async def fetch(self, payload=None, timeout=FETCH_TIMEOUT):
+    async def fetch_body():
+      response = await self.open_async(payload)
+      await response.read()
+      return response
+    return await asyncio.wait_for(fetch_body(), timeout)
+
+  # Fetches several same-origin urls, sending their GETs back to back on
+  # one keep-alive connection, at most MAX_PIPELINE_DEPTH ahead of the
+  # responses, and reading the responses in order. Only origins that have
+  # already kept a connection open are pipelined to; anything else, and
+  # anything the pipeline didn't deliver (an error, a closed connection, a
+  # redirect), is fetched on its own, all at once. Each result is a
+  # response with its body read, or the exception that fetching it raised.
+  @staticmethod
+  async def fetch_all(urls, timeout=FETCH_TIMEOUT):
+    results = {}
+    if len(urls) > 1 and not URL.replay:
+      try:
+        await asyncio.wait_for(URL.pipeline_async(urls, results), timeout)
+      except (OSError, ValueError, asyncio.IncompleteReadError,
+              asyncio.TimeoutError) as e:
+        print("Pipelining failed, fetching one at a time:", repr(e))
+    rest = [i for i in range(len(urls)) if i not in results]
+    fetched = await asyncio.gather(
+      *[urls[i].fetch(timeout=timeout) for i in rest], return_exceptions=True)
+    for i, result in zip(rest, fetched):
+      if isinstance(result, BaseException) and \
+          not isinstance(result, Exception):
+        raise result
+      results[i] = result
+    return [results[i] for i in range(len(urls))]
+
+  @staticmethod
+  async def pipeline_async(urls, results):
+    requests = []
+    for i, url in enumerate(urls):
+      if url.scheme in LOCAL_SCHEMES:
+        continue
+      url = URL.redirects.follow(url)
+      cached = URL.cache.lookup(str(url))
+      if cached and URL.cache.is_fresh(cached[0]):
+        response = url.from_cache(cached, AsyncCachedResponse)
+        response.url = url
+        log_timing(url, None, response)
+        results[i] = response
+      else:
+        requests.append((i, url, cached))
+    origins = set((url.scheme, url.host, url.port) for i, url, _ in requests)
+    pool = URL._async_connections
+    if len(requests) < 2 or len(origins) > 1 or \
+        not origins <= pool.persistent:
+      return
+
+    conn = await pool.acquire(*origins.pop())
+    try:
+      messages = [url.request_bytes(None, conditional_headers(cached))
+                  for i, url, cached in requests]
+      start = time.perf_counter()
+      await conn.send(b"".join(messages[:MAX_PIPELINE_DEPTH]))
+      sent = time.perf_counter()
+      for j, (i, url, cached) in enumerate(requests):
+        head = await read_head_async(conn.reader)
+        version, status, explanation, headers = parse_head(head)
+        print("Request URL:", str(url), "(pipelined)")
+        print("Status:", status)
+        response = AsyncResponse(conn, version, status, explanation, headers)
+        response.pipelined = True
+        response.timing = request_timing(conn, start, sent)
+        conn.reused = True # only the first response paid for the connection
+        if cached and status == "304":
+          await response.read()
+          response = url.revalidated(response, cached, AsyncCachedResponse)
+        else:
+          url.store_when_done(response)
+        if URL.recorder:
+          URL.recorder.watch(url, None, response)
+        log_timing(url, None, response)
+        response.url = url
+        await response.read()
+        if not redirect_location(response):
+          results[i] = response
+        if not is_keep_alive(version, headers) or \
+            (not response.from_cache and not response.keep_alive):
+          break
+        if j + MAX_PIPELINE_DEPTH < len(messages):
+          await conn.send(messages[j + MAX_PIPELINE_DEPTH])
+      else:
+        conn.last_used = time.monotonic()
+        pool.release(conn)
+        return
+    except BaseException:
+      pool.discard(conn)
+      raise
+    pool.discard(conn)
+
+  def from_cache(self, cached, response_class):
+    entry, body = cached
+    print("Request URL:", str(self))
+    print("Status:", entry["status"], "(from disk cache)")
+    return response_class(entry["status"], entry["headers"], body)
+
+  def revalidated(self, response, cached, response_class):
+    entry, body = cached
+    URL.cache.refresh(str(self), response.headers)
+    revalidated = response_class(entry["status"], entry["headers"], body)
+    revalidated.timing = response.timing
+    return revalidated
+
+  def store_when_done(self, response):
+    if response.status == "200":
+      key = str(self)
+      response.on_body.append(lambda body: \
+        URL.cache.store(key, response.status, response.headers, body))
+
+  def request_bytes(self, payload, headers):
     method = "POST" if payload else "GET"
-    request = "{} {} HTTP/1.0\r\n".format(method, self.path)
+    request = "{} {} HTTP/1.1\r\n".format(method, self.path)
     if payload:
       length = len(payload.encode("utf8"))
       request += "Content-Length: {}\r\n".format(length)
     request += "Host: {}\r\n".format(self.host)
+    request += "Connection: keep-alive\r\n"
+    request += "Accept-Encoding: gzip, deflate\r\n"
+    for header, value in headers.items():
+      request += "{}: {}\r\n".format(header, value)
     request += "\r\n"
     if payload:
       request += payload
-    s.send(request.encode("utf8"))
+    return request.encode("utf8")
+
+  def http_request(self, payload=None, headers={}):
+    request = self.request_bytes(payload, headers)
+    while True:
+      conn = URL._connections.acquire(self.scheme, self.host, self.port)
+      try:
+        start = time.perf_counter()
+        conn.send(request)
+        sent = time.perf_counter()
+        head = read_head(conn.file)
+        if not head:
+          raise ConnectionError("connection closed before response")
+        break
+      except OSError:
+        URL._connections.discard(conn)
+        # A pooled socket may have been closed by the server while idle;
+        # retry on a fresh connection, but don't retry a fresh one.
+        if not conn.reused:
+          raise
+      except:
+        URL._connections.discard(conn)
+        raise
 
-    response = s.makefile("r", encoding="utf8", newline="\r\n")
-    statusline = response.readline()
+    try:
+      version, status, explanation, response_headers = parse_head(head)
+      print("Request URL:", str(self))
+      print("Status:", status)
+    except:
+      URL._connections.discard(conn)
+      raise
 
-    version, status, explanation = statusline.split(" ", 2)
-    print("Request URL:", str(self))  
-    print("Status:", status)
+    response = Response(conn, version, status, explanation, response_headers)
+    response.timing = request_timing(conn, start, sent)
+    return response
 
-    response_headers = {}
+  async def http_request_async(self, payload=None, headers={}):
+    request = self.request_bytes(payload, headers)
+    pool = URL._async_connections
     while True:
-      line = response.readline()
-      if line == "\r\n": break
-      header, value = line.split(":", 1)
-      response_headers[header.casefold()] = value.strip()
+      conn = await pool.acquire(self.scheme, self.host, self.port)
+      try:
+        start = time.perf_counter()
+        await conn.send(request)
+        sent = time.perf_counter()
+        head = await read_head_async(conn.reader)
+        break
+      except (OSError, asyncio.IncompleteReadError) as e:
+        pool.discard(conn)
+        if not conn.reused:
+          raise ConnectionError("connection closed before response") from e
+      except BaseException:
+        pool.discard(conn)
+        raise
 
-    assert "transfer-encoding" not in response_headers
-    assert "content-encoding" not in response_headers
+    try:
+      version, status, explanation, response_headers = parse_head(head)
+      print("Request URL:", str(self))
+      print("Status:", status)
+    except BaseException:
+      pool.discard(conn)
+      raise
 
-    body = response.read()
-    s.close()
+    response = AsyncResponse(
+      conn, version, status, explanation, response_headers)
+    response.timing = request_timing(conn, start, sent)
+    return response
 
-    return body
+  def request(self, payload=None):
+    response = self.open(payload)
+    return decode_body(response.headers, response.read())
+
+  @classmethod
+  def close_all_connections(cls):
+    cls._connections.close_all()
+    cls._async_connections.close_all()
 
   def resolve(self, url):
-    if "://" in url:
+    key = (self, url)
+    resolved = URL._resolved.get(key)
+    if not resolved:
+      resolved = self.resolve_uncached(url)
+      URL._resolved.put(key, resolved)
+    return resolved
+
+  # Whether a document at this URL may load target as a subresource, link
+  # or redirect. Local files and data: URLs are only opened from the
+  # address bar and from other local documents, so a web page can't read
+  # the user's files.
+  def can_load(self, target):
+    return target.scheme not in LOCAL_SCHEMES or self.scheme in LOCAL_SCHEMES
+
+  def resolve_uncached(self, url):
+    if "://" in url or url.startswith("data:"):
       return URL(url)
+    if self.scheme == "data":
+      # a data: document has no location for relative links to start from
+      return URL("data:,")
     if not url.startswith("/"):
       dir, _ = self.path.rsplit("/", 1)
       while url.startswith("../"):
@@ -85,4 +1216,229 @@ class URL:
     if url.startswith("//"):
       return URL(self.scheme + ":" + url)
     else:
-      return URL(self.scheme + "://" + self.host + ":" + str(self.port) + url)
+      port_part = ":" + str(self.port) if self.port else ""
+      return URL(self.scheme + "://" + self.host + port_part + url)
+
+
+# Headers that describe the bytes on the wire rather than the stored body
+UNCACHED_HEADERS = [
+  "connection", "keep-alive", "transfer-encoding", "content-encoding",
+  "content-length",
+]
+
+# The list that records of requests made in the current context go to,
+# e.g. a Tab's resource log
+RESOURCE_LOG = contextvars.ContextVar("resource_log", default=None)
+
+def ms(seconds):
+  return round(seconds * 1000, 3)
+
+def setup_timing(start, resolved, connected, scheme):
+  now = time.perf_counter()
+  return {
+    "dns": ms(resolved - start),
+    "connect": ms(connected - resolved),
+    "tls": ms(now - connected) if scheme == "https" else None,
+  }
+
+def request_timing(conn, start, sent):
+  timing = {
+    "started": time.time() - (time.perf_counter() - start),
+    "reused": conn.reused,
+  }
+  if conn.reused:
+    timing.update({"dns": 0, "connect": 0, "tls": None})
+  else:
+    timing.update(conn.setup)
+  timing["send"] = ms(sent - start)
+  timing["ttfb"] = ms(time.perf_counter() - sent)
+  return timing
+
+def log_timing(url, payload, response):
+  timing = {
+    "url": str(url),
+    "method": "POST" if payload else "GET",
+    "status": response.status,
+    "from_cache": response.from_cache,
+    "started": time.time(),
+  }
+  timing.update(response.timing)
+  if response.from_cache:
+    timing["bytes_decoded"] = response.bytes_decoded
+  response.timing = timing
+  log = RESOURCE_LOG.get()
+  if log is not None:
+    log.append(timing)
+
+def read_head(file):
+  head = bytearray()
+  while True:
+    line = file.readline(MAX_HEAD_SIZE)
+    head += line
+    if line in (b"\r\n", b"\n", b""):
+      return head
+    if len(head) >= MAX_HEAD_SIZE:
+      raise ValueError("response head too large")
+
+# The reader's limit is MAX_HEAD_SIZE, see AsyncConnection.connect
+async def read_head_async(reader):
+  try:
+    return await reader.readuntil(b"\r\n\r\n")
+  except asyncio.LimitOverrunError:
+    raise ValueError("response head too large") from None
+
+def parse_head(head):
+  lines = head.decode("iso-8859-1").splitlines()
+  version, status, explanation = (lines[0] + " ").split(" ", 2)
+  headers = {}
+  for line in lines[1:]:
+    if not line:
+      break
+    header, value = line.split(":", 1)
+    headers[header.casefold()] = value.strip()
+  return version, status, explanation.strip(), headers
+
+# Reads the body straight into one buffer of exactly the right size and
+# yields views of it, rather than copying every chunk into a new bytes
+def read_length(file, length):
+  buffer = memoryview(bytearray(length))
+  start = 0
+  while start < length:
+    n = file.readinto(buffer[start:min(length, start + CHUNK_SIZE)])
+    if not n:
+      raise ConnectionError("connection closed while reading body")
+    yield buffer[start:start + n]
+    start += n
+
+def read_chunked(file):
+  while True:
+    line = file.readline()
+    if not line:
+      raise ConnectionError("connection closed while reading chunk size")
+    size = int(line.split(b";", 1)[0].strip(), 16)
+    if size == 0:
+      break
+    yield from read_length(file, size)
+    if file.readline() not in (b"\r\n", b"\n"):
+      raise ValueError("malformed chunk terminator")
+  # skip trailer headers up to the final blank line
+  while file.readline() not in (b"\r\n", b"\n", b""):
+    pass
+
+def read_until_close(file):
+  while True:
+    chunk = file.read1(CHUNK_SIZE)
+    if not chunk:
+      return
+    yield chunk
+
+async def read_nothing_async():
+  return
+  yield
+
+# Unlike read_length, each chunk is a new bytes object: StreamReader has
+# no readinto, so copying its chunks into one buffer would only add a copy
+async def read_length_async(reader, length):
+  while length > 0:
+    chunk = await reader.read(min(length, CHUNK_SIZE))
+    if not chunk:
+      raise ConnectionError("connection closed while reading body")
+    length -= len(chunk)
+    yield chunk
+
+async def read_chunked_async(reader):
+  while True:
+    line = await reader.readline()
+    if not line:
+      raise ConnectionError("connection closed while reading chunk size")
+    size = int(line.split(b";", 1)[0].strip(), 16)
+    if size == 0:
+      break
+    async for chunk in read_length_async(reader, size):
+      yield chunk
+    if await reader.readline() not in (b"\r\n", b"\n"):
+      raise ValueError("malformed chunk terminator")
+  while await reader.readline() not in (b"\r\n", b"\n", b""):
+    pass
+
+async def read_until_close_async(reader):
+  while True:
+    chunk = await reader.read(CHUNK_SIZE)
+    if not chunk:
+      return
+    yield chunk
+
+def content_charset(headers):
+  for param in headers.get("content-type", "").split(";")[1:]:
+    if "=" in param:
+      name, value = param.split("=", 1)
+      if name.strip().casefold() == "charset":
+        return value.strip().strip("\"'")
+  return None
+
+META_CHARSET = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?([\w-]+)", re.I)
+
+# The charset from Content-Type, else from a <meta charset> near the start
+# of the body, else UTF-8
+def sniff_charset(headers, prefix):
+  charset = content_charset(headers)
+  if not charset:
+    match = META_CHARSET.search(bytes(prefix[:SNIFF_BYTES]))
+    if match:
+      charset = match.group(1).decode("ascii")
+  try:
+    return codecs.lookup(charset or DEFAULT_CHARSET).name
+  except LookupError:
+    return DEFAULT_CHARSET
+
+def decode_body(headers, body):
+  return str(body, sniff_charset(headers, body), "replace")
+
+def redirect_location(response):
+  if response.status in ("301", "302", "303", "307", "308"):
+    location = response.headers.get("location")
+    # only http(s) redirects are followed
+    if location and ("://" not in location
+                     or location.split("://", 1)[0] in ("http", "https")):
+      return location
+  return None
+
+def conditional_headers(cached):
+  headers = {}
+  if cached:
+    entry, body = cached
+    if "etag" in entry["headers"]:
+      headers["If-None-Match"] = entry["headers"]["etag"]
+    if "last-modified" in entry["headers"]:
+      headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+  return headers
+
+def parse_cache_control(value):
+  directives = {}
+  for part in value.split(","):
+    part = part.strip()
+    if not part:
+      continue
+    if "=" in part:
+      directive, argument = part.split("=", 1)
+      directives[directive.strip().casefold()] = argument.strip().strip('"')
+    else:
+      directives[part.casefold()] = None
+  return directives
+
+def set_freshness(entry, headers):
+  cache_control = parse_cache_control(headers.get("cache-control", ""))
+  max_age = 0
+  if "no-cache" not in cache_control and "max-age" in cache_control:
+    try:
+      max_age = int(cache_control["max-age"])
+    except ValueError:
+      pass
+  entry["stored"] = time.time()
+  entry["max_age"] = max_age
+
+def is_keep_alive(version, headers):
+  connection = headers.get("connection", "").casefold()
+  if version == "HTTP/1.0":
+    return connection == "keep-alive"
+  return connection != "close"